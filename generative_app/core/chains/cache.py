@@ -0,0 +1,100 @@
+"""Cache for the LLM steps of the code chain."""
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+
+def digest(*parts: str) -> str:
+    """Stable key built from several strings."""
+    return hashlib.sha256("\x00".join(parts).encode()).hexdigest()
+
+
+class ChainCache:
+    """In memory LRU cache of the answers of the chain steps.
+
+    Answers are looked up by their exact key first. For the steps flagged as
+    semantic (the question condensing), a previous key whose embedding is close
+    enough to the new one is also a hit.
+    Only share a cache between chains built with the same prompts and models.
+    """
+
+    def __init__(
+        self,
+        embeddings: Optional[Embeddings] = None,
+        similarity_threshold: float = 0.95,
+        maxsize: int = 512,
+    ):
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+        self.maxsize = maxsize
+        self._answers: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+        self._vectors: "OrderedDict[Tuple[str, str], np.ndarray]" = OrderedDict()
+        self._last_embedding: Optional[Tuple[str, np.ndarray]] = None
+        self._lock = threading.Lock()
+
+    def _embed(self, key: str) -> np.ndarray:
+        # The key embedded on a lookup miss is embedded again on update
+        if self._last_embedding is not None and self._last_embedding[0] == key:
+            return self._last_embedding[1]
+        vector = np.asarray(self.embeddings.embed_query(key), dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        self._last_embedding = (key, vector)
+        return vector
+
+    def lookup(
+        self,
+        namespace: str,
+        key: str,
+        semantic: bool = False,
+        accept: Optional[Callable[[str], bool]] = None,
+    ) -> Optional[str]:
+        """Return the cached answer of ``key``, or None on a miss.
+        A semantic hit is only served if ``accept`` (when given) returns True for
+        its answer."""
+        with self._lock:
+            answer = self._answers.get((namespace, key))
+            if answer is not None:
+                self._answers.move_to_end((namespace, key))
+                return answer
+            candidates = [
+                (cached_key, vector)
+                for (cached_namespace, cached_key), vector in self._vectors.items()
+                if cached_namespace == namespace
+            ]
+        if not semantic or self.embeddings is None or not candidates:
+            return None
+        vector = self._embed(key)
+        similarities = [(float(v @ vector), cached_key) for cached_key, v in candidates]
+        for similarity, cached_key in sorted(similarities, reverse=True):
+            if similarity < self.similarity_threshold:
+                break
+            with self._lock:
+                answer = self._answers.get((namespace, cached_key))
+            if answer is not None and (accept is None or accept(answer)):
+                return answer
+        return None
+
+    def update(
+        self, namespace: str, key: str, answer: str, semantic: bool = False
+    ) -> None:
+        """Store the answer of ``key``."""
+        vector = None
+        if semantic and self.embeddings is not None:
+            vector = self._embed(key)
+        with self._lock:
+            self._answers[(namespace, key)] = answer
+            self._answers.move_to_end((namespace, key))
+            if vector is not None:
+                self._vectors[(namespace, key)] = vector
+            while len(self._answers) > self.maxsize:
+                evicted, _ = self._answers.popitem(last=False)
+                self._vectors.pop(evicted, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._answers.clear()
+            self._vectors.clear()
@@ -1,14 +1,35 @@
 """Chain for chatting with a vector database."""
 from __future__ import annotations
 
+import asyncio
 import inspect
+import re
+import threading
 from abc import abstractmethod
+from collections import OrderedDict
+from contextvars import ContextVar
+from functools import lru_cache
+from itertools import zip_longest
 from pathlib import Path
-from typing import Any, Callable, Dict, List, Optional, Union
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Collection,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
-from pydantic import Extra
+import tiktoken
+from pydantic import Extra, PrivateAttr, root_validator
 
 from langchain.base_language import BaseLanguageModel
+from langchain.callbacks.base import AsyncCallbackHandler
 from langchain.callbacks.manager import (
     AsyncCallbackManagerForChainRun,
     CallbackManagerForChainRun,
@@ -30,11 +51,16 @@ from langchain.chains.conversational_retrieval.base import (
 from chains.prompt import (
     CONDENSE_QUESTION_CODE_PROMPT,
     PROMPT,
+    QUERY_EXPANSION_CODE_PROMPT,
     prompt_missing_imports_check,
 )
 from utils.security import analyze_security
+from chains.cache import ChainCache, digest
 from chains.parser import parse_code
 
+OUTPUT_KEYS = ("code", "explanation")
+BANNED_WORDS_RE = re.compile(r"streamlit|python")
+
 
 def remove_entrypoint(code):
     lines = code.split("\n")
@@ -56,6 +82,188 @@ def remove_entrypoint(code):
     return modified_code
 
 
+# Formatted chat histories by id of their list, with the turns they were formatted
+# from to detect a reused id or a modified history
+_chat_history_cache: "OrderedDict[int, Tuple[List[CHAT_TURN_TYPE], str]]" = (
+    OrderedDict()
+)
+_chat_history_lock = threading.Lock()
+
+
+def _format_chat_history(chat_history: List[CHAT_TURN_TYPE]) -> str:
+    """Same as langchain's _get_chat_history, but only formats the turns appended
+    to the history since its last call: the history grows by one turn per call."""
+    with _chat_history_lock:
+        turns, buffer = _chat_history_cache.pop(id(chat_history), ([], ""))
+    if len(turns) > len(chat_history) or any(
+        turn is not cached_turn for turn, cached_turn in zip(chat_history, turns)
+    ):
+        turns, buffer = [], ""
+    buffer += _get_chat_history(chat_history[len(turns) :])
+    with _chat_history_lock:
+        _chat_history_cache[id(chat_history)] = (list(chat_history), buffer)
+        while len(_chat_history_cache) > 64:
+            _chat_history_cache.popitem(last=False)
+    return buffer
+
+
+def _generated_code(code: Optional[str]) -> Optional[str]:
+    # The answer has a "None" code block when no code was generated
+    if code is None or code.strip() in ("", "None"):
+        return None
+    return code
+
+
+@lru_cache(maxsize=None)
+def _encoding_for_model(model_name: str) -> Optional[tiktoken.Encoding]:
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return None
+
+
+# Token counts by model, special tokens settings and hash of the text, the same docs
+# are retrieved often
+_token_counts: "OrderedDict[Tuple[Any, ...], int]" = OrderedDict()
+_token_counts_lock = threading.Lock()
+
+
+def _special_tokens_key(special: Union[str, Collection[str]]) -> Any:
+    return special if isinstance(special, str) else frozenset(special)
+
+
+def _count_tokens(llm: BaseLanguageModel, texts: List[str]) -> List[int]:
+    """Number of tokens of each text, tokenized in one batch for OpenAI models, with
+    the same model and special tokens settings as ``llm.get_num_tokens``."""
+    model_name = getattr(llm, "tiktoken_model_name", None) or getattr(
+        llm, "model_name", None
+    )
+    encoding = _encoding_for_model(model_name) if model_name else None
+    if encoding is None:
+        return [llm.get_num_tokens(text) for text in texts]
+    # Only OpenAI LLMs have these settings, chat models use tiktoken's defaults
+    allowed_special = getattr(llm, "allowed_special", set())
+    disallowed_special = getattr(llm, "disallowed_special", "all")
+    settings = (
+        model_name,
+        _special_tokens_key(allowed_special),
+        _special_tokens_key(disallowed_special),
+    )
+    keys = [(*settings, hash(text)) for text in texts]
+    with _token_counts_lock:
+        counts = [_token_counts.get(key) for key in keys]
+    missing = [i for i, count in enumerate(counts) if count is None]
+    if missing:
+        token_ids = encoding.encode_batch(
+            [texts[i] for i in missing],
+            allowed_special=allowed_special,
+            disallowed_special=disallowed_special,
+        )
+        for i, ids in zip(missing, token_ids):
+            counts[i] = len(ids)
+    with _token_counts_lock:
+        for key, count in zip(keys, counts):
+            _token_counts[key] = count
+            _token_counts.move_to_end(key)
+        while len(_token_counts) > 4096:
+            _token_counts.popitem(last=False)
+    return counts
+
+
+def _merge_docs(results: List[List[Document]]) -> List[Document]:
+    """Interleave the docs retrieved for several queries by rank, without
+    duplicates."""
+    docs = []
+    seen = set()
+    for rank_docs in zip_longest(*results):
+        for doc in rank_docs:
+            if doc is not None and doc.page_content not in seen:
+                seen.add(doc.page_content)
+                docs.append(doc)
+    return docs
+
+
+@lru_cache(maxsize=None)
+def _accepts(get_docs: Callable, parameter: str) -> bool:
+    # Signatures are costly to build and never change for a given class
+    return parameter in inspect.signature(get_docs).parameters
+
+
+def _query_words(query: str) -> List[str]:
+    return re.findall(r"\w+", query.lower())
+
+
+def _is_same_query(new_request: str, request: str) -> bool:
+    """Whether the condensed query is the request itself, up to case and
+    punctuation, so that retrieving on either sends the same text."""
+    return _query_words(new_request) == _query_words(request)
+
+
+def _is_rewrite_of(new_request: str, request: str) -> bool:
+    """Whether the condensed query only keeps words of the original request."""
+    return set(_query_words(new_request)) <= set(_query_words(request))
+
+
+def _similar_condensed_query(request: str) -> Callable[[str], bool]:
+    """Whether a condensed query cached for a similar question can be served for
+    ``request``: the "None" verdict is never served (exact hits only), and the
+    query must be made of words of ``request`` so that, for instance, the
+    "slider" query of "add a slider" is not served for "add a selectbox"."""
+    return lambda new_request: (
+        "None" not in new_request and _is_rewrite_of(new_request, request)
+    )
+
+
+def _answer_key(docs: List[Document], inputs: Dict[str, Any]) -> str:
+    return digest(
+        *(f"{key}={value}" for key, value in sorted(inputs.items())),
+        *(doc.page_content for doc in docs),
+    )
+
+
+# Queue receiving the answer tokens of the calls made by astream_call
+_answer_tokens: ContextVar[Optional[asyncio.Queue]] = ContextVar(
+    "_answer_tokens", default=None
+)
+
+
+class _CodeBlockHandler(AsyncCallbackHandler):
+    """Start checking the code of a streamed answer as soon as its block is
+    complete, and forward its tokens to ``tokens`` if given."""
+
+    def __init__(
+        self,
+        check_code: Callable[[str], Awaitable[Tuple[str, bool]]],
+        tokens: Optional[asyncio.Queue] = None,
+    ) -> None:
+        super().__init__()
+        self.check_code = check_code
+        self.tokens = tokens
+        self.full_response = ""
+        self.done = False
+        self.code: Optional[str] = None
+        self.check: Optional[asyncio.Task] = None
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if self.tokens is not None:
+            self.tokens.put_nowait(token)
+        if self.done:
+            return
+        self.full_response += token
+        if not self.full_response.startswith("```python"[: len(self.full_response)]):
+            # The answer does not start with a code block
+            self.done = True
+        elif self.full_response.count("```") >= 2:
+            self.done = True
+            self.code = _generated_code(parse_code(self.full_response)[0])
+            if self.code:
+                self.check = asyncio.create_task(self.check_code(self.code))
+
+    def cancel(self) -> None:
+        if self.check is not None:
+            self.check.cancel()
+
+
 class BaseConversationalRetrievalCodeChain(Chain):
     """Chain for chatting with an index. Given the chat history,
     the current code and a question, return the answer."""
@@ -63,12 +271,24 @@ class BaseConversationalRetrievalCodeChain(Chain):
     combine_docs_chain: BaseCombineDocumentsChain
     question_generator: LLMChain
     missing_imports_chain: LLMChain
-    output_key: List[str] = ["code", "explanation"]
     return_source_documents: bool = False
     return_generated_question: bool = False
     return_revision_request: bool = False
     get_chat_history: Optional[Callable[[CHAT_TURN_TYPE], str]] = None
     """Return the source documents."""
+    speculative_retrieval: bool = False
+    """In async calls, retrieve on the raw question while it is being condensed.
+    Those docs are only kept when the condensed query is the question itself (up to
+    case and punctuation) and there are no query variants; otherwise they are
+    discarded and retrieval runs on the condensed query."""
+    concurrency_limit: Optional[int] = None
+    """Maximum number of concurrent LLM/retriever calls, across the async calls of
+    this chain."""
+    cache: Optional[ChainCache] = None
+    """Cache of the condensed questions, answers and missing imports checks."""
+    _semaphore: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Semaphore]] = (
+        PrivateAttr(default=None)
+    )
 
     class Config:
         """Configuration for this pydantic object."""
@@ -88,7 +308,7 @@ class BaseConversationalRetrievalCodeChain(Chain):
 
         :meta private:
         """
-        _output_keys = ["code", "explanation"]
+        _output_keys = list(OUTPUT_KEYS)
         if self.return_source_documents:
             _output_keys = _output_keys + ["source_documents"]
         if self.return_generated_question:
@@ -102,9 +322,54 @@ class BaseConversationalRetrievalCodeChain(Chain):
         inputs: Dict[str, Any],
         *,
         run_manager: CallbackManagerForChainRun,
+        query_variants: Sequence[str] = (),
     ) -> List[Document]:
         """Get docs."""
 
+    def _query_variants(
+        self, inputs: Dict[str, Any], *, run_manager: CallbackManagerForChainRun
+    ) -> List[str]:
+        """Variants of the question to also retrieve docs for."""
+        return []
+
+    def _cached_run(
+        self,
+        namespace: str,
+        key: str,
+        run: Callable[[], str],
+        semantic: bool = False,
+        accept: Optional[Callable[[str], bool]] = None,
+    ) -> str:
+        if self.cache is None:
+            return run()
+        answer = self.cache.lookup(namespace, key, semantic=semantic, accept=accept)
+        if answer is None:
+            answer = run()
+            self.cache.update(namespace, key, answer, semantic=semantic)
+        return answer
+
+    async def _acached_run(
+        self,
+        namespace: str,
+        key: str,
+        run: Callable[[], Awaitable[str]],
+        semantic: bool = False,
+        accept: Optional[Callable[[str], bool]] = None,
+    ) -> str:
+        if self.cache is None:
+            return await run()
+        # A semantic lookup embeds the key, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        answer = await loop.run_in_executor(
+            None, self.cache.lookup, namespace, key, semantic, accept
+        )
+        if answer is None:
+            answer = await run()
+            await loop.run_in_executor(
+                None, self.cache.update, namespace, key, answer, semantic
+            )
+        return answer
+
     def _call(
         self,
         inputs: Dict[str, Any],
@@ -112,46 +377,67 @@ class BaseConversationalRetrievalCodeChain(Chain):
     ) -> Dict[str, Any]:
         _run_manager = run_manager or CallbackManagerForChainRun.get_noop_manager()
         request = inputs["question"]
-        new_request = self.question_generator.run(
-            question=request, callbacks=_run_manager.get_child()
+        new_request = self._cached_run(
+            "condense",
+            request,
+            lambda: self.question_generator.run(
+                question=request, callbacks=_run_manager.get_child()
+            ),
+            semantic=True,
+            accept=_similar_condensed_query(request),
         )
         new_request = None if "None" in new_request else new_request
-        accepts_run_manager = (
-            "run_manager" in inspect.signature(self._get_docs).parameters
-        )
+        get_docs = type(self)._get_docs
         if new_request is not None:
-            if accepts_run_manager:
-                docs = self._get_docs(new_request, inputs, run_manager=_run_manager)
+            if _accepts(get_docs, "run_manager"):
+                kwargs: Dict[str, Any] = {"run_manager": _run_manager}
+                # Subclasses written before the query expansion don't take variants
+                if _accepts(get_docs, "query_variants"):
+                    kwargs["query_variants"] = self._query_variants(
+                        inputs, run_manager=_run_manager
+                    )
+                docs = self._get_docs(new_request, inputs, **kwargs)
             else:
                 docs = self._get_docs(new_request, inputs)  # type: ignore[call-arg]
         else:
             docs = []
 
-        new_inputs = inputs.copy()
         # Remove any mentions of streamlit or python from the question
         if new_request is not None:
-            new_request = new_request.replace("streamlit", "").replace("python", "")
-        get_chat_history = self.get_chat_history or _get_chat_history
+            new_request = BANNED_WORDS_RE.sub("", new_request)
+        get_chat_history = self.get_chat_history or _format_chat_history
         chat_history_str = get_chat_history(inputs["chat_history"])
-        new_inputs["chat_history"] = chat_history_str
-        answer = self.combine_docs_chain.run(
-            input_documents=docs, callbacks=_run_manager.get_child(), **new_inputs
+        new_inputs = {**inputs, "chat_history": chat_history_str}
+        answer = self._cached_run(
+            "answer",
+            _answer_key(docs, new_inputs),
+            lambda: self.combine_docs_chain.run(
+                input_documents=docs, callbacks=_run_manager.get_child(), **new_inputs
+            ),
         )
         code, expl = parse_code(answer)
+        code = _generated_code(code)
 
+        # No code means nothing to flag, and no check to pay for
         is_code_not_safe = False
-        if code is not None:
+        if code:
             # Run check code
             is_code_not_safe = analyze_security(code)
             if not is_code_not_safe:
                 code = remove_entrypoint(code)
                 # Check if imports are missing
-                code_checked = self.missing_imports_chain.run(code=code)
+                code_checked = self._cached_run(
+                    "missing_imports",
+                    code,
+                    lambda: self.missing_imports_chain.run(
+                        code=code, callbacks=_run_manager.get_child()
+                    ),
+                )
                 code_checked = None if code_checked == "None" else code_checked
                 if code_checked is not None:
                     code = code_checked
 
-        output: Dict[str, Any] = {self.output_key[0]: code, self.output_key[1]: expl}
+        output: Dict[str, Any] = {"code": code, "explanation": expl}
         if self.return_source_documents:
             output["source_documents"] = docs
         if self.return_generated_question:
@@ -167,9 +453,48 @@ class BaseConversationalRetrievalCodeChain(Chain):
         inputs: Dict[str, Any],
         *,
         run_manager: AsyncCallbackManagerForChainRun,
+        query_variants: Sequence[str] = (),
     ) -> List[Document]:
         """Get docs."""
 
+    async def _aquery_variants(
+        self, inputs: Dict[str, Any], *, run_manager: AsyncCallbackManagerForChainRun
+    ) -> List[str]:
+        """Variants of the question to also retrieve docs for."""
+        return []
+
+    async def _abounded(self, aw: Awaitable[Any]) -> Any:
+        """Await a single LLM or retriever call, with at most ``concurrency_limit``
+        of them running at a time."""
+        if not self.concurrency_limit:
+            return await aw
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore[0] is not loop:
+            self._semaphore = (loop, asyncio.Semaphore(self.concurrency_limit))
+        async with self._semaphore[1]:
+            return await aw
+
+    async def _acheck_code(
+        self, code: str, callbacks: Callbacks = None
+    ) -> Tuple[str, bool]:
+        """Return the code with its missing imports added and whether it is not
+        safe."""
+        is_code_not_safe = analyze_security(code)
+        if not is_code_not_safe:
+            code = remove_entrypoint(code)
+            # Check if imports are missing
+            code_checked = await self._acached_run(
+                "missing_imports",
+                code,
+                lambda: self._abounded(
+                    self.missing_imports_chain.arun(code=code, callbacks=callbacks)
+                ),
+            )
+            code_checked = None if code_checked == "None" else code_checked
+            if code_checked is not None:
+                code = code_checked
+        return code, is_code_not_safe
+
     async def _acall(
         self,
         inputs: Dict[str, Any],
@@ -177,49 +502,112 @@ class BaseConversationalRetrievalCodeChain(Chain):
     ) -> Dict[str, Any]:
         _run_manager = run_manager or AsyncCallbackManagerForChainRun.get_noop_manager()
         request = inputs["question"]
-        new_request = await self.question_generator.arun(
-            question=request, callbacks=_run_manager.get_child()
-        )
-        new_request = None if "None" in new_request else new_request
-        accepts_run_manager = (
-            "run_manager" in inspect.signature(self._aget_docs).parameters
+        get_docs = type(self)._aget_docs
+        accepts_run_manager = _accepts(get_docs, "run_manager")
+        # Subclasses written before the query expansion don't take variants
+        accepts_query_variants = _accepts(get_docs, "query_variants")
+
+        async def _aget_docs(
+            question: str, query_variants: Sequence[str] = ()
+        ) -> List[Document]:
+            if not accepts_run_manager:
+                return await self._aget_docs(question, inputs)  # type: ignore[call-arg]
+            kwargs: Dict[str, Any] = {"run_manager": _run_manager}
+            if accepts_query_variants and query_variants:
+                kwargs["query_variants"] = query_variants
+            return await self._aget_docs(question, inputs, **kwargs)
+
+        # Generate the query variants while the question is condensed, they are
+        # cancelled if the question turns out not to be relevant
+        query_variants: "asyncio.Future[List[str]]"
+        if accepts_run_manager and accepts_query_variants:
+            query_variants = asyncio.ensure_future(
+                self._aquery_variants(inputs, run_manager=_run_manager)
+            )
+        else:
+            query_variants = asyncio.get_running_loop().create_future()
+            query_variants.set_result([])
+        # Condense the question and, if enabled, speculatively retrieve on the raw
+        # request at the same time: both are network bound.
+        condense = self._acached_run(
+            "condense",
+            request,
+            lambda: self._abounded(
+                self.question_generator.arun(
+                    question=request, callbacks=_run_manager.get_child()
+                )
+            ),
+            semantic=True,
+            accept=_similar_condensed_query(request),
         )
-        if new_request is not None:
-            if accepts_run_manager:
-                docs = await self._aget_docs(
-                    new_request, inputs, run_manager=_run_manager
+        try:
+            if self.speculative_retrieval:
+                new_request, speculative_docs = await asyncio.gather(
+                    condense, _aget_docs(request)
                 )
             else:
-                docs = await self._aget_docs(new_request, inputs)  # type: ignore[call-arg]
-        else:
+                new_request = await condense
+                speculative_docs = None
+        except BaseException:
+            query_variants.cancel()
+            raise
+        new_request = None if "None" in new_request else new_request
+        if new_request is None:
+            query_variants.cancel()
             docs = []
+        else:
+            variants = await query_variants
+            if (
+                speculative_docs is not None
+                and not variants
+                and _is_same_query(new_request, request)
+            ):
+                docs = speculative_docs
+            else:
+                docs = await _aget_docs(new_request, variants)
 
-        new_inputs = inputs.copy()
         # Remove any mentions of streamlit or python from the question
         if new_request is not None:
-            new_request = new_request.replace("streamlit", "").replace("python", "")
-        get_chat_history = self.get_chat_history or _get_chat_history
+            new_request = BANNED_WORDS_RE.sub("", new_request)
+        get_chat_history = self.get_chat_history or _format_chat_history
         chat_history_str = get_chat_history(inputs["chat_history"])
-        new_inputs["chat_history"] = chat_history_str
-        answer = await self.combine_docs_chain.arun(
-            input_documents=docs, callbacks=_run_manager.get_child(), **new_inputs
+        new_inputs = {**inputs, "chat_history": chat_history_str}
+        # Check the code as soon as its block is streamed, while the explanation
+        # is still being generated
+        code_block_handler = _CodeBlockHandler(
+            lambda code: self._acheck_code(code, callbacks=_run_manager.get_child()),
+            tokens=_answer_tokens.get(),
         )
+        callbacks = _run_manager.get_child()
+        callbacks.add_handler(code_block_handler)
+        try:
+            answer = await self._acached_run(
+                "answer",
+                _answer_key(docs, new_inputs),
+                lambda: self._abounded(
+                    self.combine_docs_chain.arun(
+                        input_documents=docs, callbacks=callbacks, **new_inputs
+                    )
+                ),
+            )
+        except BaseException:
+            code_block_handler.cancel()
+            raise
         code, expl = parse_code(answer)
+        code = _generated_code(code)
 
-        is_code_not_safe = True
-        if code is not None:
-            # Run check code
-            is_code_not_safe = analyze_security(code)
-            # Check if imports are missing
-            if not is_code_not_safe:
-                code = remove_entrypoint(code)
-                # Check if imports are missing
-                code_checked = self.missing_imports_chain.run(code=code)
-                code_checked = None if code_checked == "None" else code_checked
-                if code_checked is not None:
-                    code = code_checked
+        # No code means nothing to flag, and no check to pay for
+        is_code_not_safe = False
+        if code:
+            if code == code_block_handler.code:
+                code, is_code_not_safe = await code_block_handler.check
+            else:
+                code_block_handler.cancel()
+                code, is_code_not_safe = await self._acheck_code(
+                    code, callbacks=_run_manager.get_child()
+                )
 
-        output: Dict[str, Any] = {self.output_key[0]: code, self.output_key[1]: expl}
+        output: Dict[str, Any] = {"code": code, "explanation": expl}
         if self.return_source_documents:
             output["source_documents"] = docs
         if self.return_generated_question:
@@ -228,6 +616,40 @@ class BaseConversationalRetrievalCodeChain(Chain):
             output["revision_request"] = is_code_not_safe
         return output
 
+    async def astream_call(
+        self, inputs: Dict[str, Any], callbacks: Callbacks = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Run the chain asynchronously, yielding the answer tokens as they are
+        generated as ``{"delta": token}``, then the outputs of the chain.
+
+        This is an API for async callers: the Streamlit chat calls the chain
+        synchronously and streams the tokens through its LLM callback handler."""
+        tokens: asyncio.Queue = asyncio.Queue()
+        # The call task copies the current context, and with it the queue
+        context_token = _answer_tokens.set(tokens)
+        try:
+            call = asyncio.create_task(
+                self.acall(inputs, callbacks=callbacks, return_only_outputs=True)
+            )
+        finally:
+            _answer_tokens.reset(context_token)
+
+        try:
+            while not call.done():
+                get_token = asyncio.ensure_future(tokens.get())
+                await asyncio.wait(
+                    {get_token, call}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if get_token.done():
+                    yield {"delta": get_token.result()}
+                else:
+                    get_token.cancel()
+            while not tokens.empty():
+                yield {"delta": tokens.get_nowait()}
+            yield await call
+        finally:
+            call.cancel()
+
     def save(self, file_path: Union[Path, str]) -> None:
         if self.get_chat_history:
             raise ValueError("Chain not savable when `get_chat_history` is not None.")
@@ -242,6 +664,51 @@ class ConversationalRetrievalCodeChain(BaseConversationalRetrievalCodeChain):
     max_tokens_limit: Optional[int] = None
     """If set, restricts the docs to return from store based on tokens, enforced only
     for StuffDocumentChain"""
+    query_expansions: int = 0
+    """Number of query variants of the question to also retrieve docs for."""
+    query_expansion_chain: Optional[LLMChain] = None
+    """Chain generating the query variants, required if query_expansions is set."""
+
+    @root_validator()
+    def validate_query_expansion_chain(cls, values: Dict) -> Dict:
+        if (
+            values.get("query_expansions")
+            and values.get("query_expansion_chain") is None
+        ):
+            raise ValueError("query_expansion_chain is required by query_expansions.")
+        return values
+
+    def _parse_query_variants(self, variants: str) -> List[str]:
+        queries = [query.strip() for query in variants.splitlines()]
+        return [query for query in queries if query][: self.query_expansions]
+
+    def _query_variants(
+        self, inputs: Dict[str, Any], *, run_manager: CallbackManagerForChainRun
+    ) -> List[str]:
+        """Variants of the question to also retrieve docs for."""
+        if not self.query_expansions:
+            return []
+        variants = self.query_expansion_chain.run(
+            n=self.query_expansions,
+            question=inputs["question"],
+            callbacks=run_manager.get_child(),
+        )
+        return self._parse_query_variants(variants)
+
+    async def _aquery_variants(
+        self, inputs: Dict[str, Any], *, run_manager: AsyncCallbackManagerForChainRun
+    ) -> List[str]:
+        """Variants of the question to also retrieve docs for."""
+        if not self.query_expansions:
+            return []
+        variants = await self._abounded(
+            self.query_expansion_chain.arun(
+                n=self.query_expansions,
+                question=inputs["question"],
+                callbacks=run_manager.get_child(),
+            )
+        )
+        return self._parse_query_variants(variants)
 
     def _reduce_tokens_below_limit(self, docs: List[Document]) -> List[Document]:
         num_docs = len(docs)
@@ -249,14 +716,16 @@ class ConversationalRetrievalCodeChain(BaseConversationalRetrievalCodeChain):
         if self.max_tokens_limit and isinstance(
             self.combine_docs_chain, StuffDocumentsChain
         ):
-            tokens = [
-                self.combine_docs_chain.llm_chain.llm.get_num_tokens(doc.page_content)
-                for doc in docs
-            ]
-            token_count = sum(tokens[:num_docs])
-            while token_count > self.max_tokens_limit:
-                num_docs -= 1
-                token_count -= tokens[num_docs]
+            tokens = _count_tokens(
+                self.combine_docs_chain.llm_chain.llm,
+                [doc.page_content for doc in docs],
+            )
+            token_count = 0
+            for i, num_tokens in enumerate(tokens):
+                token_count += num_tokens
+                if token_count > self.max_tokens_limit:
+                    num_docs = i
+                    break
 
         return docs[:num_docs]
 
@@ -266,10 +735,17 @@ class ConversationalRetrievalCodeChain(BaseConversationalRetrievalCodeChain):
         inputs: Dict[str, Any],
         *,
         run_manager: CallbackManagerForChainRun,
+        query_variants: Sequence[str] = (),
     ) -> List[Document]:
         """Get docs."""
-        docs = self.retriever.get_relevant_documents(
-            question, callbacks=run_manager.get_child()
+        queries = [question, *query_variants]
+        docs = _merge_docs(
+            [
+                self.retriever.get_relevant_documents(
+                    query, callbacks=run_manager.get_child()
+                )
+                for query in queries
+            ]
         )
         return self._reduce_tokens_below_limit(docs)
 
@@ -279,10 +755,21 @@ class ConversationalRetrievalCodeChain(BaseConversationalRetrievalCodeChain):
         inputs: Dict[str, Any],
         *,
         run_manager: AsyncCallbackManagerForChainRun,
+        query_variants: Sequence[str] = (),
     ) -> List[Document]:
         """Get docs."""
-        docs = await self.retriever.aget_relevant_documents(
-            question, callbacks=run_manager.get_child()
+        queries = [question, *query_variants]
+        docs = _merge_docs(
+            await asyncio.gather(
+                *(
+                    self._abounded(
+                        self.retriever.aget_relevant_documents(
+                            query, callbacks=run_manager.get_child()
+                        )
+                    )
+                    for query in queries
+                )
+            )
         )
         return self._reduce_tokens_below_limit(docs)
 
@@ -296,6 +783,7 @@ class ConversationalRetrievalCodeChain(BaseConversationalRetrievalCodeChain):
         verbose: bool = False,
         condense_question_llm: Optional[BaseLanguageModel] = None,
         missing_imports_llm: Optional[BaseLanguageModel] = None,
+        query_expansions: int = 0,
         combine_docs_chain_kwargs: Optional[Dict] = None,
         callbacks: Callbacks = None,
         **kwargs: Any,
@@ -324,11 +812,22 @@ class ConversationalRetrievalCodeChain(BaseConversationalRetrievalCodeChain):
             llm=_llm_3, prompt=prompt_missing_imports_check
         )
 
+        query_expansion_chain = None
+        if query_expansions:
+            query_expansion_chain = LLMChain(
+                llm=_llm,
+                prompt=QUERY_EXPANSION_CODE_PROMPT,
+                verbose=verbose,
+                callbacks=callbacks,
+            )
+
         return cls(
             retriever=retriever,
             combine_docs_chain=doc_chain,
             question_generator=condense_question_chain,
             missing_imports_chain=missing_imports_chain,
+            query_expansions=query_expansions,
+            query_expansion_chain=query_expansion_chain,
             callbacks=callbacks,
             **kwargs,
         )
@@ -20,6 +20,7 @@ from langchain.callbacks.base import AsyncCallbackHandler, BaseCallbackHandler
 from streamlit.delta_generator import DeltaGenerator
 
 from chains import doc_retriever
+from chains.cache import ChainCache
 from chains.conversational_retrieval_over_code import ConversationalRetrievalCodeChain
 from chains.parser import parse_code
 
@@ -169,6 +170,14 @@ class Handler(BaseCallbackHandler):
         )
 
 
+@st.cache_resource
+def load_chain_cache() -> ChainCache:
+    # Shared by every session, the chains are always built the same way.
+    # Exact matches only: the app calls the chain synchronously, where a semantic
+    # lookup would add an embeddings request before every condense call it misses
+    return ChainCache()
+
+
 def load_conversation_chain(
     message_placeholder: DeltaGenerator, openai_api_key: str
 ) -> ConversationalRetrievalCodeChain:
@@ -203,6 +212,7 @@ def load_conversation_chain(
         return_source_documents=True,
         missing_imports_llm=missing_imports_llm,
         return_revision_request=True,
+        cache=load_chain_cache(),
         verbose=False,
     )
     return qa_over_streamlit_code
@@ -283,13 +293,13 @@ def load_chat_agent():
 
 
 # https://regex101.com/r/fHlyKq/1
-parse_code_regex = r"(```python(.*?)```)?(.*?)$"
+parse_code_regex = re.compile(r"(```python(.*?)```)?(.*?)$", re.DOTALL)
 
 
 def parse(output):
     python_code = None
     explain_code = None
-    python_code_match = re.search(parse_code_regex, output, re.DOTALL)
+    python_code_match = parse_code_regex.search(output)
     if python_code_match:
         python_code = python_code_match.group(2)
         explain_code = python_code_match.group(3)
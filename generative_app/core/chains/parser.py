@@ -1,11 +1,20 @@
-import re
+CODE_BLOCK_START = "```python"
+CODE_BLOCK_END = "```"
+
+
+def _strip_last_newline(text):
+    # Same as the former `(?P<explanation>.*?)$` regex group
+    return text[:-1] if text.endswith("\n") else text
 
 
 def parse_code(output):
-    python_code = None
-    explain_code = None
-    pattern = r"(?P<code>```python(?P<python>.*?)```)?(?P<explanation>.*?)$"
-    python_code_match = re.search(pattern, output, re.DOTALL)
-    python_code = python_code_match.group("python")
-    explain_code = python_code_match.group("explanation")
+    # The code block can only be at the start of the output. Plain string
+    # searches are used: they are linear in the output length, without backtracking
+    if not output.startswith(CODE_BLOCK_START):
+        return None, _strip_last_newline(output)
+    end = output.find(CODE_BLOCK_END, len(CODE_BLOCK_START))
+    if end == -1:
+        return None, _strip_last_newline(output)
+    python_code = output[len(CODE_BLOCK_START) : end]
+    explain_code = _strip_last_newline(output[end + len(CODE_BLOCK_END) :])
     return python_code, explain_code
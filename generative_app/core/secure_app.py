@@ -3,12 +3,12 @@ from hydralit import HydraApp
 from app_pages.login_app import LoginApp
 from app_pages.signup import SignUpApp
 from app_pages.about import About
-from app_pages.appifyai import ChatBotApp
 from app_pages.load_app import LoadingApp
 from app_pages.user_guide import UserGuide
 import sidebar
 from version import VERSION
 
+import importlib.util
 import os
 import re
 from utils.parser import parse_current_app
@@ -43,35 +43,69 @@ st.set_page_config(
     },
 )
 
+
+def load_sandbox_app(sandboxe_name: str, path_to_script: str):
+    """Load the App of the user sandbox. The module is kept in the session and only
+    executed again when the sandbox file changes."""
+    sandboxes = st.session_state.setdefault("sandboxes", {})
+    mtime = os.stat(path_to_script).st_mtime_ns
+    if sandboxe_name not in sandboxes or sandboxes[sandboxe_name][0] != mtime:
+        spec = importlib.util.spec_from_file_location(sandboxe_name, path_to_script)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sandboxes[sandboxe_name] = (mtime, module.App("Generated App"))
+    return sandboxes[sandboxe_name][1]
+
+
+def load_hydra_app() -> HydraApp:
+    """Build the host application with the apps every visitor can access, once per
+    session."""
+    if "hydra_app" not in st.session_state:
+        over_theme = {
+            "txc_inactive": "#FFFFFF",
+            "menu_background": "#26272f",
+            "txc_active": "white",
+            "option_active": "#3e404f",
+        }
+        # this is the host application, we add children to it and that's it!
+        app = HydraApp(
+            title="AppifyAi",
+            favicon="🤖",
+            nav_container=st.sidebar,
+            use_navbar=True,
+            navbar_sticky=False,
+            navbar_animation=False,
+            navbar_theme=over_theme,
+        )
+
+        # we want to have secure access for this HydraApp, so we provide a login
+        # application optional logout label, can be blank for something nicer!
+        app.add_app("About", About(title="About"), is_unsecure=True)
+        app.add_app("Logout", LoginApp(title="Login"), is_home=True, is_login=True)
+        app.add_app(
+            "User Guide", UserGuide(title="User Guide"), icon="📜", is_unsecure=True
+        )
+        app.add_app(
+            "Signup", icon="🛰️", app=SignUpApp(title="Signup"), is_unsecure=True
+        )
+        app.add_loader_app(LoadingApp(delay=1))
+        st.session_state.hydra_app = app
+    return st.session_state.hydra_app
+
+
+def reset_hydra_app():
+    """Drop the session host and sandbox, so that the apps registered for the
+    previous user are not kept for the next one."""
+    st.session_state.pop("hydra_app", None)
+    st.session_state.pop("sandboxes", None)
+
+
 if __name__ == "__main__":
-    over_theme = {
-        "txc_inactive": "#FFFFFF",
-        "menu_background": "#26272f",
-        "txc_active": "white",
-        "option_active": "#3e404f",
-    }
-    # this is the host application, we add children to it and that's it!
-    app = HydraApp(
-        title="AppifyAi",
-        favicon="🤖",
-        nav_container=st.sidebar,
-        use_navbar=True,
-        navbar_sticky=False,
-        navbar_animation=False,
-        navbar_theme=over_theme,
-    )
+    app = load_hydra_app()
 
     # Authentication instance
     auth = AuthSingleton().get_instance()
 
-    # we want to have secure access for this HydraApp, so we provide a login application
-    # optional logout label, can be blank for something nicer!
-    app.add_app("About", About(title="About"), is_unsecure=True)
-    app.add_app("Logout", LoginApp(title="Login"), is_home=True, is_login=True)
-    app.add_app("User Guide", UserGuide(title="User Guide"), icon="📜", is_unsecure=True)
-    app.add_app("Signup", icon="🛰️", app=SignUpApp(title="Signup"), is_unsecure=True)
-    app.add_loader_app(LoadingApp(delay=1))
-
     # check user access level to determine what should be shown on the menu
     user_access_level, username = app.check_access()
 
@@ -86,6 +120,7 @@ if __name__ == "__main__":
                 )
             )
             auth.remove_user_session(user_access_level)
+        reset_hydra_app()
 
     # ---------------------------------------------------------------------
 
@@ -93,7 +128,7 @@ if __name__ == "__main__":
     # ---------------------------------------------------------------------
     @app.login_callback
     def mylogin_cb():
-        pass
+        reset_hydra_app()
 
     # ---------------------------------------------------------------------
 
@@ -110,18 +145,10 @@ if __name__ == "__main__":
     elif user_access_level > 0:
         sandboxe_name = "_".join([username, str(user_access_level)])
 
-        # Dynamically import the sandbox
-        import importlib
-
         path_to_script = os.path.join(
             os.getcwd(), "generative_app", "sandboxes", f"{sandboxe_name}.py"
         )
-        spec = importlib.util.spec_from_file_location(
-            f"{username}_{user_access_level}", path_to_script
-        )
-        module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
-        app_to_add = module.App("Generated App")
+        app_to_add = load_sandbox_app(sandboxe_name, path_to_script)
 
         # if path not in sys.path:
         #    sys.path.append(path)
@@ -129,6 +156,9 @@ if __name__ == "__main__":
         title = f"{username} - Generated App"
         # app_to_add = importlib.import_module(f"{sandboxe_name}", "../..").App("Generated App")
 
+        # Only logged in users need the chatbot (and the langchain stack it imports)
+        from app_pages.appifyai import ChatBotApp
+
         # add all your application classes here
         app.add_app(
             "AppifyAi",
@@ -140,9 +170,9 @@ if __name__ == "__main__":
         app.add_app(title, icon="💫", app=app_to_add)
         complex_nav = {
             "AppifyAi": ["AppifyAi"],
+            title: [title],
+            "User Guide": ["User Guide"],
         }
-        complex_nav.update({title: [title]})
-        complex_nav.update({"User Guide": ["User Guide"]})
     else:
         complex_nav = {"User Guide": ["User Guide"]}
 